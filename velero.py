@@ -11,43 +11,184 @@ Wrapper commands around velero that do things like.
 - Setting S3 Policies for backup buckets that are created.
 
 """
+import functools
+import hashlib
 import json
 import logging
 import os
 import shutil
 import sys
+import time
 
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 
 from subprocess import CalledProcessError, PIPE, run
 
-import boto3
-
 REQUIRED_VELERO_VERSION = "v1.4.2"
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "velero-wrapper")
+IAM_CACHE_TTL = 300
+
+# Static leading arguments of the velero commands built by the wrappers below.
+BACKUP_PREFIX = ("velero", "backup", "create")
+SCHEDULE_PREFIX = ("velero", "create", "schedule")
+RESTORE_PREFIX = ("velero", "restore", "create")
+INSTALL_PREFIX = (
+    "velero",
+    "install",
+    "--provider",
+    "aws",
+    "--plugins",
+    "velero/velero-plugin-for-aws:v1.1.0",
+)
+
+log = logging.getLogger(os.path.basename(__file__))
+
+# IAM policy for the velero user; {BUCKET} is substituted with the backup bucket name.
+VELERO_POLICY_TEMPLATE = json.dumps(
+    {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "ec2:DescribeVolumes",
+                    "ec2:DescribeSnapshots",
+                    "ec2:CreateTags",
+                    "ec2:CreateVolume",
+                    "ec2:CreateSnapshot",
+                    "ec2:DeleteSnapshot",
+                ],
+                "Resource": "*",
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "s3:GetObject",
+                    "s3:DeleteObject",
+                    "s3:PutObject",
+                    "s3:AbortMultipartUpload",
+                    "s3:ListMultipartUploadParts",
+                ],
+                "Resource": ["arn:aws:s3:::{BUCKET}/*"],
+            },
+            {
+                "Effect": "Allow",
+                "Action": ["s3:ListBucket"],
+                "Resource": ["arn:aws:s3:::{BUCKET}"],
+            },
+        ],
+    },
+    separators=(",", ":"),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name):
+    """Return the path of executable `name` on $PATH, memoized per process."""
+    return shutil.which(name)
+
+
+def _write_cache_file(cache_file, contents):
+    """Atomically write `contents` to `cache_file` under CACHE_DIR, readable only by the owner."""
+    tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        f.write(contents)
+    os.replace(tmp_file, cache_file)
+
+
+def _list_users_cached(session, ttl=IAM_CACHE_TTL):
+    """Return (IAM user names, whether they came from the cache), cached on disk for `ttl` seconds.
+
+    The full listing is needed to populate the cache, so pages are not scanned lazily.
+    """
+    # IAM is global, so key by account; profiles and regions can cover the same account
+    # and env/role credentials can reach different accounts under one profile name.
+    account = session.client("sts").get_caller_identity()["Account"]
+    cache_file = os.path.join(CACHE_DIR, "iam-{}.json".format(account))
+    try:
+        if os.path.getmtime(cache_file) > time.time() - ttl:
+            with open(cache_file) as f:
+                return json.load(f), True
+    except (OSError, ValueError):
+        pass
+
+    paginator = session.client("iam").get_paginator("list_users")
+    pages = paginator.paginate(PaginationConfig={"PageSize": 1000})
+    users = [user["UserName"] for page in pages for user in page["Users"]]
+    try:
+        _write_cache_file(cache_file, json.dumps(users))
+    except OSError as e:
+        log.debug("Unable to cache IAM users: %s", e)
+    return users, False
+
+
+@functools.lru_cache(maxsize=1)
+def _velero_version():
+    """Return the velero version installed, or None if not found."""
+    velero_path = _which("velero")
+    if not velero_path:
+        return None
+    key = hashlib.sha1((velero_path + str(os.path.getmtime(velero_path))).encode()).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, "version-{}.txt".format(key))
+    try:
+        with open(cache_file) as f:
+            version = f.read().strip()
+        if version:
+            log.debug("Cached Velero version is %s", version)
+            return version
+    except OSError:
+        pass
+
+    version_output = run(
+        ["velero", "version", "--client-only"], check=True, stdout=PIPE
+    ).stdout.decode().strip()
+    log.debug("Velero version output: %s", version_output)
+    version = version_output.split()[2]
+    log.debug("Current Velero version is %s", version)
+    try:
+        _write_cache_file(cache_file, version)
+    except OSError as e:
+        log.debug("Unable to cache Velero version: %s", e)
+
+    return version
 
 
 class VeleroCommand:
-    """Base class for running Velero commands."""
+    """Base class for Velero commands that need AWS access.
+
+    Building it imports boto3 and creates a Session, so only subclass it from
+    commands that talk to AWS; the other wrappers stay standalone classes.
+    """
 
     def __init__(self, args):
         """ Initializing class for the VeleroCommands."""
-        self.log = logging.getLogger(os.path.basename(__file__))
+        # Imported here so subcommands that never touch AWS skip loading boto3.
+        import boto3
+
+        self.log = log
         self.profile = args.profile
-        self.log.info("Setting AWS profile to {}".format(self.profile))
-        self.session = boto3.session.Session(profile_name=self.profile)
+        self.backup_region = getattr(args, "backup_region", None)
+        self.log.info("Setting AWS profile to %s", self.profile)
+        # An explicit region keeps botocore from probing the EC2 metadata endpoint for one.
+        self.session = boto3.session.Session(
+            profile_name=self.profile, region_name=self.backup_region
+        )
+        # Reuse one client/resource per service instead of rebuilding them per call.
+        self.session.client = functools.lru_cache(maxsize=None)(self.session.client)
+        self.session.resource = functools.lru_cache(maxsize=None)(self.session.resource)
 
     def _check_roles(self):
         """ Check if the velero role exits in the IAM user list."""
-        iam = self.session.client("iam")
-        users = []
-        for user in iam.list_users()["Users"]:
-            users.append(user["UserName"])
+        users, from_cache = _list_users_cached(self.session)
+        if "velero" not in users and from_cache:
+            # A cached listing may predate the velero user, so re-list before giving up.
+            users, _ = _list_users_cached(self.session, ttl=0)
         if "velero" in users:
-            self.log.info("User velero exists under {} profile".format(self.profile))
+            self.log.info("User velero exists under %s profile", self.profile)
             return True
-        else:
-            self.log.error("velero user doesn't exist under profile {}".format(self.profile))
-            sys.exit(2)
+        self.log.error("velero user doesn't exist under profile %s", self.profile)
+        sys.exit(2)
 
 
 class DescribeCommand:
@@ -59,7 +200,7 @@ class DescribeCommand:
         Args:
             args (argparse.Namespace): Args returned by ArgumentParser.parse_args().
         """
-        self.log = logging.getLogger(os.path.basename(__file__))
+        self.log = log
         self.backup_name = args.backup_name
         self.state = args.state
 
@@ -67,22 +208,18 @@ class DescribeCommand:
 
     def __call__(self):
         """ Run `velero describe` checks for the existing bucket."""
-        self.log.info("Running describe command: %s", " ".join(self.command))
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info("Running describe command: %s", " ".join(self.command))
         try:
             run(self.command, check=True)
         except CalledProcessError as e:
-            self.log.error("Cannot fetch {} {} \n {}".format(self.backup_name, self.state, e))
+            self.log.error("Cannot fetch %s %s \n %s", self.backup_name, self.state, e)
 
     def _construct_command(self):
         """ Construct `velero describe` command, save as self.command."""
-        command = [
-            "velero",
-            "{}".format(self.state),
-            "describe",
-            "{}".format(self.backup_name),
-            "--details",
-        ]
-        self.log.debug("Constructed describe command: %s", " ".join(command))
+        command = ["velero", self.state, "describe", self.backup_name, "--details"]
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Constructed describe command: %s", " ".join(command))
         self.command = command
 
 
@@ -95,31 +232,32 @@ class BackupCommand:
         Args:
             args (argparse.Namespace): Args returned by ArgumentParser.parse_args().
         """
-        self.log = logging.getLogger(os.path.basename(__file__))
+        self.log = log
         self.backup_name = args.backup_name
         self.exclude_namespaces = ",".join(args.exclude_namespaces)
         self._construct_command()
 
     def __call__(self):
         """Run `velero backup` checks for existing bucket."""
-        self.log.info("Running backup command: %s", " ".join(self.command))
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info("Running backup command: %s", " ".join(self.command))
 
         try:
-            run(" ".join(self.command), check=True, shell=True)
+            run(self.command, check=True)
         except Exception as e:
-            self.log.error("{} backup cannot be created \n {}".format(self.backup_name, e))
+            self.log.error("%s backup cannot be created \n %s", self.backup_name, e)
 
     def _construct_command(self):
         """Construct `velero backup` command, save as self.command."""
         command = [
-            "velero",
-            "backup",
-            "create",
-            "{}".format(self.backup_name),
-            "--exclude-namespaces {}".format(self.exclude_namespaces),
+            *BACKUP_PREFIX,
+            self.backup_name,
+            "--exclude-namespaces",
+            self.exclude_namespaces,
             "--wait",
         ]
-        self.log.debug("Constructed backup command: %s", " ".join(command))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Constructed backup command: %s", " ".join(command))
         self.command = command
 
 
@@ -131,7 +269,7 @@ class ScheduleCommand:
         """Args:
             args (argparse.Namespace): Args returned by ArgumentParser.parse_args().
         """
-        self.log = logging.getLogger(os.path.basename(__file__))
+        self.log = log
         self.schedule_name = args.schedule_name
         self.include_namespaces = ",".join(args.include_namespaces)
         self.cron = args.cron
@@ -140,26 +278,29 @@ class ScheduleCommand:
 
     def __call__(self):
         """ Run `velero schedule` to perform scheduled backups."""
-        self.log.info("Running schedule command: %s", " ".join(self.command))
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info("Running schedule command: %s", " ".join(self.command))
         try:
-            run(" ".join(self.command), check=True, shell=True)
+            run(self.command, check=True)
         except Exception as e:
             self.log.error(
-                "Schedule command cannot be performed for {} \n {}".format(self.schedule_name, e)
+                "Schedule command cannot be performed for %s \n %s", self.schedule_name, e
             )
 
     def _construct_command(self):
         """ Construct `velero schedule` command, save as self.command."""
         command = [
-            "velero",
-            "create",
-            "schedule",
-            "{}".format(self.schedule_name),
-            '--schedule="@every {}h"'.format(self.cron),
-            "--include-namespaces {}".format(self.include_namespaces),
-            "--ttl {}h".format(self.ttl),
+            *SCHEDULE_PREFIX,
+            self.schedule_name,
+            "--schedule",
+            "@every {}h".format(self.cron),
+            "--include-namespaces",
+            self.include_namespaces,
+            "--ttl",
+            "{}h".format(self.ttl),
         ]
-        self.log.debug("Constructed schedule command: %s", " ".join(command))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Constructed schedule command: %s", " ".join(command))
         self.command = command
 
 
@@ -172,29 +313,25 @@ class RestoreCommand:
         Args:
             args (argparse.Namespace): Args returned by ArgumentParser.parse_args().
         """
-        self.log = logging.getLogger(os.path.basename(__file__))
+        self.log = log
         self.backup_name = args.backup_name
 
         self._construct_command()
 
     def __call__(self):
         """Run `velero restore` checks for the existing bucket."""
-        self.log.info("Running restore command: %s", " ".join(self.command))
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info("Running restore command: %s", " ".join(self.command))
         try:
-            run(" ".join(self.command), check=True, shell=True)
+            run(self.command, check=True)
         except Exception as e:
-            self.log.error("Restore cannot be performed from {} \n {}".format(self.backup_name, e))
+            self.log.error("Restore cannot be performed from %s \n %s", self.backup_name, e)
 
     def _construct_command(self):
         """ Construct `velero restore` command, save as self.command."""
-        command = [
-            "velero",
-            "restore",
-            "create",
-            "--from-backup {}".format(self.backup_name),
-            "--wait",
-        ]
-        self.log.debug("Constructed restore command: %s", " ".join(command))
+        command = [*RESTORE_PREFIX, "--from-backup", self.backup_name, "--wait"]
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Constructed restore command: %s", " ".join(command))
         self.command = command
 
 
@@ -209,7 +346,6 @@ class InstallCommand(VeleroCommand):
         """
         super(InstallCommand, self).__init__(args)
         self.bucket = args.bucket
-        self.backup_region = args.backup_region
         self.snapshot_region = args.snapshot_region
         self.secret = args.secret
         self.create_bucket = args.create_bucket
@@ -218,165 +354,136 @@ class InstallCommand(VeleroCommand):
     def __call__(self):
         """ Run `velero install` checks for the existing bucket."""
         if self.create_bucket:
+            # Never grant the velero user access to a bucket that already exists.
+            self._check_bucket_missing()
+            # put_user_policy replaces the velero policy, so only point it at a bucket that exists.
             self.create_backup_bucket()
             self.assign_bucket_policy()
         else:
             self._check_bucket_exists()
-        self.log.info("Running install command: %s", " ".join(self.command))
-        run([" ".join(self.command)], shell=True)
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info("Running install command: %s", " ".join(self.command))
+        try:
+            run(self.command, check=True)
+        except Exception as e:
+            self.log.error("Velero cannot be installed using %s \n %s", self.bucket, e)
 
     def _construct_command(self):
         """ Construct `velero install` command, save as self.command."""
         command = [
-            "velero",
-            "install",
-            "--provider aws",
-            "--plugins velero/velero-plugin-for-aws:v1.1.0",
-            "--bucket {}".format(self.bucket),
-            "--backup-location-config region={}".format(self.backup_region),
-            "--snapshot-location-config region={}".format(self.snapshot_region),
-            "--secret-file ./{}".format(self.secret),
+            *INSTALL_PREFIX,
+            "--bucket",
+            self.bucket,
+            "--backup-location-config",
+            "region={}".format(self.backup_region),
+            "--snapshot-location-config",
+            "region={}".format(self.snapshot_region),
+            "--secret-file",
+            "./{}".format(self.secret),
         ]
-        self.log.debug("Constructed install command: %s", " ".join(command))
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Constructed install command: %s", " ".join(command))
         self.command = command
 
     def create_backup_bucket(self):
         """ Create a new backup bucket during fresh setup of velero."""
         s3 = self.session.resource("s3")
-        if s3.Bucket("{}".format(self.bucket)) in s3.buckets.all():
-            self.log.error(
-                "Unable to create Bucket {}. It already exists under {} region".format(
-                    self.bucket, self.backup_region
-                )
+        self.log.info("Creating %s bucket under %s region", self.bucket, self.backup_region)
+        try:
+            s3.create_bucket(
+                Bucket=self.bucket,
+                CreateBucketConfiguration={"LocationConstraint": self.backup_region},
             )
+        except Exception as e:
+            self.log.error("Unable to create bucket due to below exception \n %s", e)
             sys.exit(1)
-        else:
-            self.log.info(
-                "Creating {} bucket under {} region".format(self.bucket, self.backup_region)
+
+    def _check_bucket_missing(self):
+        """ Exit with error if the s3 backup bucket to be created already exists."""
+        # Anything but 404 (e.g. 403 for a bucket owned elsewhere) means the name is taken.
+        if self._bucket_status() != "404":
+            self.log.error(
+                "Unable to create Bucket %s. It already exists under %s region",
+                self.bucket,
+                self.backup_region,
             )
-            try:
-                s3.create_bucket(
-                    Bucket="{}".format(self.bucket),
-                    CreateBucketConfiguration={
-                        "LocationConstraint": "{}".format(self.backup_region)
-                    },
-                )
-            except Exception as e:
-                self.log.error("Unable to create bucket due to below exception \n {}".format(e))
-                sys.exit(1)
+            sys.exit(1)
 
     def assign_bucket_policy(self):
         """ Method assigns velero s3 policy for the bucket."""
-        self.log.info("Assigning velero user policy to {}".format(self.bucket))
-        velero_bucket_policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "ec2:DescribeVolumes",
-                        "ec2:DescribeSnapshots",
-                        "ec2:CreateTags",
-                        "ec2:CreateVolume",
-                        "ec2:CreateSnapshot",
-                        "ec2:DeleteSnapshot",
-                    ],
-                    "Resource": "*",
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "s3:GetObject",
-                        "s3:DeleteObject",
-                        "s3:PutObject",
-                        "s3:AbortMultipartUpload",
-                        "s3:ListMultipartUploadParts",
-                    ],
-                    "Resource": ["arn:aws:s3:::{}/*".format(self.bucket)],
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": ["s3:ListBucket"],
-                    "Resource": ["arn:aws:s3:::{}".format(self.bucket)],
-                },
-            ],
-        }
+        self.log.info("Assigning velero user policy to %s", self.bucket)
         try:
             iam = self.session.client("iam")
             iam.put_user_policy(
                 UserName="velero",
                 PolicyName="velero",
-                PolicyDocument=json.dumps(velero_bucket_policy),
+                PolicyDocument=VELERO_POLICY_TEMPLATE.replace("{BUCKET}", self.bucket),
             )
         except Exception as e:
-            self.log.error("Error while attaching policy to {}. \n {}".format(self.bucket, e))
+            self.log.error("Error while attaching policy to %s. \n %s", self.bucket, e)
             sys.exit(0)
 
     def _check_bucket_exists(self):
         """ Exit with error if the s3 backup dont exist."""
-        s3 = self.session.resource("s3")
-        self.log.info("Checking if {} bucket exists".format(self.bucket))
-        if not s3.Bucket("{}".format(self.bucket)) in s3.buckets.all():
+        self.log.info("Checking if %s bucket exists", self.bucket)
+        # Only a successful HEAD proves the bucket exists and is accessible to this account.
+        if self._bucket_status() != "200":
             self.log.error(
-                "Bucket {} doesn't exists under {} region".format(self.bucket, self.backup_region)
+                "Bucket %s doesn't exists under %s region", self.bucket, self.backup_region
             )
             sys.exit(1)
 
+    def _bucket_status(self):
+        """ Return the HTTP status of a HEAD request on the backup bucket, e.g. "200" or "404"."""
+        from botocore.exceptions import ClientError
+
+        s3 = self.session.client("s3")
+        try:
+            s3.head_bucket(Bucket=self.bucket)
+        except ClientError as e:
+            return e.response["Error"]["Code"]
+        return "200"
+
 
 class CommandLine:
     """ Class to implement the command line interface, like argument parsing."""
 
+    # Only InstallCommand builds a boto3 Session; it is instantiated after the version check.
+    HANDLERS = {
+        "describe": DescribeCommand,
+        "backup": BackupCommand,
+        "install": InstallCommand,
+        "restore": RestoreCommand,
+        "schedule": ScheduleCommand,
+    }
+
     def __init__(self):
         """ Initialize the CLI, parse args, and config logging."""
+        if sys.argv[1:] == ["required-version"]:
+            # Answer without building the argument parser.
+            self._required_version()
         self._parse_args()
         logging.basicConfig(level=getattr(logging, self.args.log_level.upper(), None))
-        self.log = logging.getLogger(os.path.basename(__file__))
+        self.log = log
         self.log.debug("Parsed args: %s", self.args)
 
     def __call__(self):
         """Run commands for velero by calling."""
-        if self.args.command == "describe":
-            self._check_velero_version()
-            describe = DescribeCommand(self.args)
-            describe()
-        elif self.args.command == "backup":
-            self._check_velero_version()
-            backup = BackupCommand(self.args)
-            backup()
-        elif self.args.command == "install":
-            self._check_velero_version()
-            install = InstallCommand(self.args)
-            install()
-        elif self.args.command == "restore":
-            self._check_velero_version()
-            restore = RestoreCommand(self.args)
-            restore()
-        elif self.args.command == "schedule":
-            self._check_velero_version()
-            schedule = ScheduleCommand(self.args)
-            schedule()
-        elif self.args.command == "required-version":
+        if self.args.command == "required-version":
             self._required_version()
-        else:
+        handler = self.HANDLERS.get(self.args.command)
+        if handler is None:
             self.arg_parser.print_help()
+        else:
+            self._check_velero_version()
+            command = handler(self.args)
+            command()
 
         sys.exit(0)
 
-    def _velero_version(self):
-        """Return the velero version installed, or None if not found."""
-        velero_path = shutil.which("velero")
-        if not velero_path:
-            return None
-        version_output = run(["velero", "version"], check=True, stdout=PIPE).stdout.decode().strip()
-        self.log.debug("Velero version output: %s", version_output)
-        version = version_output.split()[2]
-        self.log.debug("Current Velero version is %s", version)
-
-        return version
-
     def _check_velero_version(self):
         """Exit with error if installed version does not match the required version."""
-        version = self._velero_version()
+        version = _velero_version()
         if version != REQUIRED_VELERO_VERSION:
             self.log.error(
                 "Wrong Velero version. Found %s, require %s", version, REQUIRED_VELERO_VERSION
@@ -386,7 +493,7 @@ class CommandLine:
     def _required_version(self):
         """ Print the required version and find a version of Velero, and exit."""
         print("Required Velero version:", REQUIRED_VELERO_VERSION)
-        print("Velero version found:", self._velero_version())
+        print("Velero version found:", _velero_version())
         sys.exit(0)
 
     def _parse_args(self):
@@ -395,14 +502,14 @@ class CommandLine:
         parser.add_argument(
             "--log-level",
             dest="log_level",
-            choices=set(["critical", "error", "warning", "info", "debug"]),
+            choices=("critical", "error", "warning", "info", "debug"),
             default="info",
             help="Log level",
         )
         parser.add_argument(
             "--profile",
             dest="profile",
-            choices=set(["default"]),
+            choices=("default",),
             default="default",
             help="AWS profile name. Else default profile will be considered.",
         )
@@ -415,7 +522,7 @@ class CommandLine:
             "--state",
             dest="state",
             required=True,
-            choices=set(["backup", "restore"]),
+            choices=("backup", "restore"),
             help="Provide the name of existing backup or restore",
         )
         describe_parser.add_argument(